@@ -1,18 +1,27 @@
-import json
 import re
 import sys
+import threading
 from abc import ABC, abstractmethod
-from functools import lru_cache
 from typing import ClassVar
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 
 import requests
+from requests.adapters import HTTPAdapter, Retry
 from crossref.restful import Works, Etiquette
 
 from tack.models import Paper, AuthorOfPaper, Citation
 from tack.progress import ProgressBar
 from tack import db, helpers
 
+# maximum number of concurrent requests to an API, shared by the worker pool
+# and the HTTP connection pool so that no worker waits on a free connection
+MAX_CONNECTIONS = 16
+
+CROSSREF_WORKS_URL = "https://api.crossref.org/works"
+
+# number of DOIs to look up in a single filter query
+CROSSREF_BATCH_SIZE = 50
+
 
 class BaseAPI(ABC):
     API_NAME: ClassVar[str]
@@ -25,6 +34,18 @@ class BaseAPI(ABC):
     def citations_by_doi(self, doi: str) -> list[Citation]:
         raise NotImplementedError()
 
+    def prefetch_citations(self, doi: str) -> None:
+        """
+        Start loading whatever `citations_by_doi` needs in the background. Optional, does nothing by default.
+        """
+        pass
+
+    def cancel_prefetch(self) -> None:
+        """
+        Drop all background work started by `prefetch_citations` that has not started yet. Does nothing by default.
+        """
+        pass
+
     @abstractmethod
     def authors_of_paper(self, doi: str) -> list[AuthorOfPaper]:
         raise NotImplementedError()
@@ -37,37 +58,142 @@ class BaseAPI(ABC):
 class CrossRefApi(BaseAPI):
     API_NAME = "crossref"
 
-    _pool: ThreadPoolExecutor
+    _pool: ThreadPoolExecutor | None
     _rate_limit: helpers.RateLimiter
+    _session: requests.Session
+    _paper_mem: dict[str, dict | None]
+    _prefetching: dict[str, list[Future]]
+    _prefetch_cancelled: threading.Event
 
     def __init__(self):
         super().__init__()
 
-        self.api = Works(
-            etiquette=Etiquette(
-                "tack",
-                "0.1.0",
-                "https://github.com/antonlydike/tack",
-                "tack@antonlydike.de",
+        etiquette = Etiquette(
+            "tack",
+            "0.1.0",
+            "https://github.com/antonlydike/tack",
+            "tack@antonlydike.de",
+        )
+        # one keep-alive session for all requests, so that we don't pay a TLS
+        # handshake for every single DOI we look up
+        self._session = requests.Session()
+        self._session.headers["User-Agent"] = str(etiquette)
+        self._session.headers["Connection"] = "keep-alive"
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=8,
+                pool_maxsize=MAX_CONNECTIONS,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    raise_on_status=False,
+                ),
+            ),
+        )
+
+        self.api = Works(etiquette=etiquette)
+        # route all requests made by the crossref library through our session
+        self.api.do_http_request = self._do_http_request
+        # created on first use, most commands never need it
+        self._pool = None
+        self._rate_limit = helpers.RateLimiter(5, 2)
+        # decoded crossref responses, entries never change so they don't need invalidation
+        self._paper_mem = {}
+        self._prefetching = {}
+        self._prefetch_cancelled = threading.Event()
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                MAX_CONNECTIONS, thread_name_prefix=self.API_NAME
             )
+        return self._pool
+
+    def _do_http_request(
+        self,
+        method: str,
+        endpoint: str,
+        data: dict | None = None,
+        files=None,
+        timeout: int = 100,
+        only_headers: bool = False,
+        custom_header: dict | None = None,
+    ) -> requests.Response:
+        """
+        Drop-in replacement for `crossref.restful.HTTPRequest.do_http_request` that re-uses our session.
+        """
+        if only_headers:
+            return self._session.head(endpoint, timeout=2, headers=custom_header)
+        if method == "post":
+            return self._session.post(
+                endpoint, data=data, files=files, timeout=timeout, headers=custom_header
+            )
+        return self._session.get(
+            endpoint, params=data, timeout=timeout, headers=custom_header
         )
-        self._pool = ThreadPoolExecutor(8)
-        self._rate_limit = helpers.RateLimiter(5, 2, random_stagger=1.5)
 
-    @lru_cache()
-    def _fetch_paper(self, doi: str) -> dict | None:
+    def _prefetch_cache(self, dois: list[str]):
+        """
+        Load the cached responses for all given DOIs using a single query, so that `_fetch_paper` does not need to
+        go to the database for each of them.
+        """
+        cached = db.get_cached_responses([f"crossref+{doi}" for doi in dois])
+        for doi in dois:
+            if (res := cached.get(f"crossref+{doi}")) is not None:
+                self._paper_mem[doi] = helpers.json_loads(res.response)
+
+    def _fetch_paper(
+        self, doi: str, cancelled: threading.Event | None = None
+    ) -> dict | None:
+        if doi in self._paper_mem:
+            return self._paper_mem[doi]
         if (res := db.has_cached_response(f"crossref+{doi}")) is not None:
-            return json.loads(res.response)
+            data = helpers.json_loads(res.response)
         else:
-            with self._rate_limit.session():
+            with self._rate_limit.session(cancelled):
                 try:
                     data = self.api.doi(doi)
                 except requests.JSONDecodeError as ex:
                     print(f"Error fetching DOI {doi}")
                     print(ex)
                     data = None
-            db.cache_response(f"crossref+{doi}", json.dumps(data))
-            return data
+            db.cache_response(f"crossref+{doi}", helpers.json_dumps(data))
+        self._paper_mem[doi] = data
+        return data
+
+    def _fetch_papers_batch(self, dois: list[str]):
+        """
+        Fetch multiple works with a single filter query and put them into the cache.
+
+        Only works that are part of the response are cached, DOIs missing from it are left to `_fetch_paper`. A DOI
+        can be missing without being unknown, e.g. when it contains a comma and breaks up the filter.
+        """
+        with self._rate_limit.session():
+            try:
+                resp = self._session.get(
+                    CROSSREF_WORKS_URL,
+                    params={
+                        "filter": ",".join(f"doi:{doi}" for doi in dois),
+                        "rows": len(dois),
+                    },
+                    timeout=30,
+                )
+                resp.raise_for_status()
+                items = resp.json()["message"]["items"]
+            except (requests.RequestException, ValueError, KeyError) as ex:
+                print(f"Error fetching DOIs {', '.join(dois)}: {ex}", file=sys.stderr)
+                return
+
+        # crossref returns lower-case DOIs, while we store them in upper case
+        found = {item["DOI"].upper(): item for item in items}
+        with db.transaction():
+            for doi in dois:
+                if (data := found.get(doi.upper())) is None:
+                    continue
+                self._paper_mem[doi] = data
+                db.cache_response(f"crossref+{doi}", helpers.json_dumps(data))
 
     def _abstract_of(self, data: dict):
         if "abstract" in data:
@@ -92,59 +218,104 @@ class CrossRefApi(BaseAPI):
             url=data.get("URL"),
         )
 
+    def prefetch_citations(self, doi: str) -> None:
+        data = self._fetch_paper(doi)
+        if data is None or doi in self._prefetching:
+            return
+
+        dois = [elm["DOI"] for elm in data.get("reference", []) if needs_enrichment(elm)]
+        local = db.get_local_citations([d.upper() for d in dois])
+        dois = [d for d in dois if d.upper() not in local]
+        self._prefetch_cache(dois)
+        pool = self._get_pool()
+        self._prefetching[doi] = [
+            pool.submit(self._fetch_paper, d, self._prefetch_cancelled)
+            for d in dois
+            if d not in self._paper_mem
+        ]
+
+    def cancel_prefetch(self) -> None:
+        self._prefetching.clear()
+        # wake up fetches waiting on the rate limit, later prefetches get a fresh event
+        self._prefetch_cancelled.set()
+        self._prefetch_cancelled = threading.Event()
+        if self._pool is not None:
+            # queued fetches are dropped, so that exiting doesn't wait on them
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
     def citations_by_doi(self, doi: str) -> list[Citation]:
         data = self._fetch_paper(doi)
         if data is None:
             return []
 
+        # let a running prefetch finish, failed fetches are retried (and reported) below
+        wait(self._prefetching.pop(doi, []))
+
+        # build citations in reference order, references without a title but with a DOI get enriched first
+        references = data.get("reference", [])
+        results: list[Citation | None] = [None] * len(references)
+        to_enrich: list[tuple[int, dict]] = []
+        for i, elm in enumerate(references):
+            if needs_enrichment(elm):
+                to_enrich.append((i, elm))
+            elif "article-title" in elm or "DOI" in elm:
+                results[i] = citation_of_reference(elm)
+
+        # references we already have in the database don't need to be fetched
+        local = db.get_local_citations([elm["DOI"].upper() for _, elm in to_enrich])
+        if local:
+            remaining = []
+            for i, elm in to_enrich:
+                if (cite := local.get(elm["DOI"].upper())) is not None:
+                    cite.doi = elm["DOI"]
+                    results[i] = cite
+                else:
+                    remaining.append((i, elm))
+            to_enrich = remaining
+
         # fetch all DOIs to get richer info:
-        tasks = []
+        self._prefetch_cache([elm["DOI"] for _, elm in to_enrich])
         progress = ProgressBar(0)
-        for elm in data.get("reference", []):
-            if "DOI" in elm and "article-title" not in elm:
-
-                def tasklet(elm_dict: dict):
-                    try:
-                        local_data = self._fetch_paper(elm_dict["DOI"])
-                        if local_data is None:
-                            return
-                        elm_dict["year"] = (
-                            local_data["published-print"]["date-parts"][0][0]
-                            if "published-print" in local_data
-                            else None
-                        )
-                        elm_dict["article-title"] = get_paper_title(local_data)
-                        authors = local_data.get("author", [])
-                        if authors:
-                            author = authors[0]
-                            elm_dict["author"] = f"{author['given']} {author['family']}"
-                        elm_dict["journal-title"] = get_event_title_short(local_data)
-                        progress.increment()
-                    except Exception as ex:
-                        print(
-                            f"Error enriching citation for {elm_dict['DOI']}: {ex}",
-                            file=sys.stderr,
-                        )
-
-                tasks.append(self._pool.submit(tasklet, elm))
+
+        tasks = [
+            (i, self._get_pool().submit(self._enrich_reference, elm, progress))
+            for i, elm in to_enrich
+        ]
 
         progress.update_size(len(tasks))
         # await tasks
-        for task in tasks:
-            task.result()
+        for i, task in tasks:
+            results[i] = task.result()
         print("")
 
-        return [
-            db.Citation(
-                cite.get("article-title"),
-                cite.get("journal-title"),
-                cite.get("DOI"),
-                cite.get("year"),
-                cite.get("author"),
+        return [cite for cite in results if cite is not None]
+
+    def _enrich_reference(self, elm_dict: dict, progress: ProgressBar) -> Citation:
+        """
+        Fill in title, year, first author and venue of a reference by looking up its DOI.
+        """
+        try:
+            local_data = self._fetch_paper(elm_dict["DOI"])
+            if local_data is not None:
+                elm_dict["year"] = (
+                    local_data["published-print"]["date-parts"][0][0]
+                    if "published-print" in local_data
+                    else None
+                )
+                elm_dict["article-title"] = get_paper_title(local_data)
+                authors = local_data.get("author", [])
+                if authors:
+                    author = authors[0]
+                    elm_dict["author"] = f"{author['given']} {author['family']}"
+                elm_dict["journal-title"] = get_event_title_short(local_data)
+                progress.increment()
+        except Exception as ex:
+            print(
+                f"Error enriching citation for {elm_dict['DOI']}: {ex}",
+                file=sys.stderr,
             )
-            for cite in data.get("reference", [])
-            if "article-title" in cite or "DOI" in cite
-        ]
+        return citation_of_reference(elm_dict)
 
     def authors_of_paper(self, doi: str) -> list[AuthorOfPaper]:
         data = self._fetch_paper(doi)
@@ -162,14 +333,24 @@ class CrossRefApi(BaseAPI):
         ]
 
     def paper_titles_from_doi(self, dois: list[str]) -> list[str | None]:
-        return list(
-            self._pool.map(
-                lambda doi: unify_none_and_dict(self._fetch_paper(doi)).get(
-                    "title", [None]
-                )[0],
-                dois,
+        self._prefetch_cache(dois)
+        missing = [doi for doi in dict.fromkeys(dois) if doi not in self._paper_mem]
+        batches = [
+            self._get_pool().submit(
+                self._fetch_papers_batch, missing[i : i + CROSSREF_BATCH_SIZE]
             )
-        )
+            for i in range(0, len(missing), CROSSREF_BATCH_SIZE)
+        ]
+        # batches fill the memo themselves, so finish order doesn't matter
+        for batch in as_completed(batches):
+            batch.result()
+
+        return [
+            unify_none_and_dict(
+                self._paper_mem[doi] if doi in self._paper_mem else self._fetch_paper(doi)
+            ).get("title", [None])[0]
+            for doi in dois
+        ]
 
     def __hash__(self):
         return hash(self.API_NAME)
@@ -178,6 +359,23 @@ class CrossRefApi(BaseAPI):
         return isinstance(other, CrossRefApi) and other.API_NAME == self.API_NAME
 
 
+def needs_enrichment(ref: dict) -> bool:
+    """
+    References that have a DOI but no title are looked up to get title, authors, etc.
+    """
+    return "DOI" in ref and "article-title" not in ref
+
+
+def citation_of_reference(ref: dict) -> Citation:
+    return Citation(
+        ref.get("article-title"),
+        ref.get("journal-title"),
+        ref.get("DOI"),
+        ref.get("year"),
+        ref.get("author"),
+    )
+
+
 def unify_none_and_dict(elm: dict | None) -> dict:
     return elm if elm else {}
 
@@ -198,27 +396,29 @@ def get_paper_title(res: dict) -> str | None:
     return f"{res['title'][0]}: {res['subtitle'][0]}"
 
 
+# trailing "CGO 2024."
+_CONF_TRAIL = re.compile(r"\.? ([A-Z0-9_+/\-]+) (\d{4})\.?$")
+# starting "SC20: ..."
+_CONF_LEAD = re.compile(r"([A-Z0-9_+/\-]+\d\d):")
+# ^.* <year> .* (conference-shorthand)$
+_CONF_PAREN = re.compile(r"(?:(?:^|\s)(\d\d(?:\d\d)?))? .*\(([^)]+)\)$")
+
+
 def shorten_conference(conference_name: str) -> str:
-    # look for trailing "CGO 2024."
-    match = re.search(r"\.? ([A-Z-_\d+/]+) (\d{4})\.?$", conference_name)
+    name = conference_name.strip()
+
+    match = _CONF_TRAIL.search(name)
     if match is not None:
         return f"{match.group(1)} '{int(match.group(2)) % 100:02}"
 
-    # look for starting "SC20: ..."
-    match = re.match(r"([A-Z-_\d+/]+\d\d):", conference_name)
+    match = _CONF_LEAD.match(name)
     if match is not None:
         return match.group(1)
 
-    # look for ^.* <year> .* (conference-shorthand)$
-    match = re.search(r"((^|\s)\d\d(\d\d)?)? .*\(([^)]+)\)$", conference_name.strip())
+    match = _CONF_PAREN.search(name)
     if match is not None:
-        year: int | None = None
         if match.group(1) is not None:
-            year = int(match.group(1).strip())
-
-        if year is not None:
-            return f"{match.group(4)} '{year % 100:02}"
-
-        return match.group(4)
+            return f"{match.group(2)} '{int(match.group(1)) % 100:02}"
+        return match.group(2)
 
     return conference_name
@@ -1,76 +1,120 @@
 import json
 import os.path
-import shutil
+import sys
 from collections.abc import Sequence
-from typing import Iterable
+from functools import cached_property
+from typing import Callable, Iterable, TYPE_CHECKING
 
 from tack import db
-from tack.api import BaseAPI, CrossRefApi
-from tack.colors import FMT
-from tack.docs import MarkdownFile, write_markdown, build_refs, read_markdown
-from tack.helpers import path_safe_doi, normalize_doi
-import argparse
+from tack.colors import FMT, ERR
+from tack.helpers import path_safe_doi, normalize_doi, json_dumpb
+
+# argparse, shutil, tack.docs (yaml) and tack.api (requests) are imported where they
+# are needed, so that quick commands don't pay for loading them
+if TYPE_CHECKING:
+    import argparse
+
+    from tack.api import BaseAPI
 
 
 class CLI:
     _name: str
-    _api: BaseAPI
+    _api: "BaseAPI | None"
+    _ensured_dirs: set[str]
+
+    _list_parser: "argparse.ArgumentParser | None" = None
 
     def __init__(self, name: str = "tack"):
         self._name = name
-        self._api = CrossRefApi()
+        self._api = None
+        self._ensured_dirs = set()
+
+    @property
+    def api(self) -> "BaseAPI":
+        """
+        The API client. Importing and creating it is expensive, so it only happens once a command needs it.
+        """
+        if self._api is None:
+            from tack.api import CrossRefApi
+
+            self._api = CrossRefApi()
+        return self._api
+
+    @cached_property
+    def repo_dir(self) -> str:
+        """
+        The directory the paper notes are stored in.
+        """
+        return db.get_paper_dir()
+
+    def _note_path(self, doi: str) -> str:
+        """
+        Path of the markdown note of a paper.
+        """
+        agency, number = path_safe_doi(doi)
+        return os.path.join(self.repo_dir, agency, f"{number}.md")
+
+    def _ensure_dir(self, path: str):
+        if path not in self._ensured_dirs:
+            os.makedirs(path, exist_ok=True)
+            self._ensured_dirs.add(path)
 
     def add(self, doi: str):
         """
         Add a paper to the collection. Search by DOI number.
         """
         print(f"fetching {doi}...")
-        paper = self._api.paper_by_doi(doi)
+        paper = self.api.paper_by_doi(doi)
         if paper is None:
             print(
-                f'{FMT.RED | FMT.BOLD}Error: Could not locate work with doi "{doi}"{FMT.RESET}'
+                f'{ERR}Error: Could not locate work with doi "{doi}"{FMT.RESET}'
             )
             return
         else:
             print(
-                f'found it on {self._api.API_NAME}, title "{paper.title}"! inserting....'
+                f'found it on {self.api.API_NAME}, title "{paper.title}"! inserting....'
             )
 
-        new_paper = db.add_paper(paper)
-
-        if new_paper:
-            authors = self._api.authors_of_paper(doi)
-
-            for author in authors:
-                if author.orcid is None:
-                    matches = db.similar_authors(author.name)
-                    if not matches:
-                        continue
-                    print(
-                        f"No ORCID associated with {author.name}, but possible matches found in local database:"
-                    )
-                    last_id = -1
-                    idx_to_author_id = {}
-                    for id, name, title, year in matches:
-                        if last_id != id:
-                            idx_to_author_id[len(idx_to_author_id) + 1] = id
-                            print(f"({len(idx_to_author_id)}): {name}")
-                        print(f"  {title} ({year})")
-                    selection = input(
-                        "\nSelect author id, or press enter to create a new author:"
-                    )
-                    if not selection:
-                        continue
-                    if int(selection) not in idx_to_author_id:
-                        print("Invalid ID entered.")
-                        # FIXME: retry
-                    author.id = idx_to_author_id[int(selection)]
-
-            db.add_authors(doi, authors)
+        if not db.has_paper(doi):
+            # start fetching the references while the authors are sorted out
+            self.api.prefetch_citations(doi)
+            try:
+                authors = self.api.authors_of_paper(doi)
+
+                for author in authors:
+                    if author.orcid is None:
+                        matches = db.similar_authors(author.name)
+                        if not matches:
+                            continue
+                        print(
+                            f"No ORCID associated with {author.name}, but possible matches found in local database:"
+                        )
+                        last_id = -1
+                        idx_to_author_id = {}
+                        for id, name, title, year in matches:
+                            if last_id != id:
+                                idx_to_author_id[len(idx_to_author_id) + 1] = id
+                                print(f"({len(idx_to_author_id)}): {name}")
+                            print(f"  {title} ({year})")
+                        selection = input(
+                            "\nSelect author id, or press enter to create a new author:"
+                        )
+                        if not selection:
+                            continue
+                        if int(selection) not in idx_to_author_id:
+                            print("Invalid ID entered.")
+                            # FIXME: retry
+                        author.id = idx_to_author_id[int(selection)]
+            except BaseException:
+                # don't keep fetching references for a paper that is not going to be added
+                self.api.cancel_prefetch()
+                raise
 
             print("fetching citations...")
+            citations = self.api.citations_by_doi(doi)
 
-            db.add_citations(doi, self._api.citations_by_doi(doi))
+            # insert everything in one transaction, after all network and user interaction is done
+            db.add_paper_full(paper, authors, citations)
 
         else:
             print("Existing paper, not adding authors and citations to db...")
@@ -85,38 +129,32 @@ class CLI:
         db.migrate()
 
     def create_note(self, doi: str):
-        repo_dir = db.get_paper_dir()
-        agency, number = path_safe_doi(doi)
-        os.makedirs(os.path.join(repo_dir, agency), exist_ok=True)
+        from tack.docs import MarkdownFile, write_markdown, build_refs, read_markdown
 
-        with db.cursor() as cur:
-            paper = cur.execute(
-                "SELECT `title`, `conference`, `year`, `abstract`, `url` FROM papers WHERE `doi` = ?",
-                (doi,),
-            ).fetchone()
-            if not paper:
-                print(
-                    f'{FMT.RED | FMT.BOLD}Error: Could not locate work with doi "{doi}"{FMT.RESET}'
-                )
-                return
-            title, conference, year, abstract, url = paper
-
-        authors = db.get_authors(doi)
+        path = self._note_path(doi)
+        self._ensure_dir(os.path.dirname(path))
+
+        paper, authors, citations, tags = db.get_note_bundle(doi)
+        if paper is None:
+            print(
+                f'{ERR}Error: Could not locate work with doi "{doi}"{FMT.RESET}'
+            )
+            return
 
         doc = MarkdownFile(
-            os.path.join(repo_dir, agency, f"{number}.md"),
+            path,
             build_paper_meta_dict(
-                doi,
-                title,
-                year,
-                conference,
+                paper.title,
+                paper.year,
+                paper.conference,
                 authors,
-                url,
+                paper.url,
+                tags,
             ),
-            title,
-            abstract,
+            paper.title,
+            paper.abstract,
             None,
-            list(build_refs(db.get_paper_citations(doi))),
+            build_refs(citations),
         )
 
         # don't overwrite added metadata and notes
@@ -125,23 +163,18 @@ class CLI:
             doc.notes = existing_doc.notes
             doc.meta = {**existing_doc.meta, **doc.meta}
 
-        write_markdown(doc)
-
-        print("Generated paper entry!")
+        if write_markdown(doc):
+            print("Generated paper entry!")
+        else:
+            print("Paper entry is up to date!")
 
     def remove(self, doi: str):
         """
         Remove a paper from the database (without deleting the local markdown file).
         """
         with db.cursor() as cur:
-            cur.execute("DELETE FROM paper_authors WHERE doi = ?", (doi,))
-            cur.execute("DELETE FROM tags WHERE doi = ?", (doi,))
-            cur.execute("DELETE FROM cites WHERE source_doi = ?", (doi,))
+            # authors, tags and citations are cleaned up by the papers_delete trigger
             cur.execute("DELETE FROM papers WHERE doi = ?", (doi,))
-            # delete trailing authors
-            cur.execute(
-                "DELETE FROM authors WHERE orcid is null and id not in (SELECT author_id FROM paper_authors)"
-            )
 
         print("Removed paper from db, not removing local file though.")
 
@@ -149,99 +182,69 @@ class CLI:
         """
         List papers added to the database, optionally with --json to print as JSON lines
         """
-        parser = argparse.ArgumentParser("tack list")
-        parser.add_argument("--json", action="store_true")
-        opts = parser.parse_args(args)
+        # the common invocations don't need argparse at all, it only handles help and usage errors
+        if all(arg == "--json" for arg in args):
+            as_json = bool(args)
+        else:
+            if CLI._list_parser is None:
+                import argparse
 
-        with db.cursor() as cur:
-            cur.execute("SELECT doi, title, conference, year FROM papers")
+                parser = argparse.ArgumentParser("tack list")
+                parser.add_argument("--json", action="store_true")
+                CLI._list_parser = parser
+            as_json = CLI._list_parser.parse_args(args).json
 
-            while batch := cur.fetchmany(100):
+        def lines(cur):
+            while batch := cur.fetchmany(1000):
                 for line in batch:
                     doi, title, conference, year = [
                         x if x is not None else "-" for x in line
                     ]
-                    if opts.json:
-                        print(
-                            json.dumps(
-                                dict(
-                                    doi=doi,
-                                    conference=conference,
-                                    year=year,
-                                    title=title,
-                                )
+                    if as_json:
+                        yield json_dumpb(
+                            dict(
+                                doi=doi,
+                                conference=conference,
+                                year=year,
+                                title=title,
                             )
-                        )
+                        ) + b"\n"
                     else:
-                        print(f"{doi:<32} | {conference:<25} | {year:>4} | {title}")
+                        yield f"{doi:<32} | {conference:<25} | {year:>4} | {title}\n".encode()
+
+        with db.cursor(read_only=True) as cur:
+            cur.execute("SELECT doi, title, conference, year FROM papers")
+            sys.stdout.flush()
+            sys.stdout.buffer.writelines(lines(cur))
 
     def run(self, cmd: str, *args: str) -> int:
-        match (cmd, args):
-            case ("migrate", []):
-                self.migrate_db()
-                return 0
-            case ("add", [doi]):
-                self.add(normalize_doi(doi))
-                return 0
-            case ("remove", [doi]):
-                self.remove(normalize_doi(doi))
-                return 0
-            case ("delete", [doi]):
-                self.remove(normalize_doi(doi))
-                return 0
-            case ("list", args):
-                self.list(args)
-                return 0
-            case ("read-md", [doi]):
-                self.read_md(normalize_doi(doi))
-                return 0
-            case ("pdf", [doi, path]):
-                self.add_pdf(normalize_doi(doi), path)
-            case ("grep", args):
-                import subprocess
-
-                subprocess.run(
-                    ["rg", *args],
-                    cwd=db.get_paper_dir(),
-                )
-                return 0
-            case ("git", args):
-                import subprocess
-
-                subprocess.run(
-                    ["git", *args],
-                    cwd=db.get_paper_dir(),
-                )
-                return 0
-            case ("help", _):
-                self.help()
-                return 0
-
-        print("unknown command")
-        return 1
+        command = _DISPATCH.get(cmd)
+        if command is None or (command[0] is not None and len(args) != command[0]):
+            print("unknown command")
+            return 1
+
+        command[1](self, *args)
+        return 0
+
+    def _run_in_paper_dir(self, *cmd: str):
+        import subprocess
+
+        subprocess.run(cmd, cwd=self.repo_dir)
 
     def help(self):
+        import shutil
+
         print(f"""{self._name} -- A tool to catalogue your read papers
         
 USAGE: {self._name} COMMAND (ARGS*)
 
 COMMANDS:""")
 
-        commands = {
-            "add": docstr_to_pars(CLI.add.__doc__),
-            "pdf": docstr_to_pars(CLI.add_pdf.__doc__),
-            "list": docstr_to_pars(CLI.list.__doc__),
-            "read-md": docstr_to_pars(CLI.read_md.__doc__),
-            "remove": docstr_to_pars(CLI.remove.__doc__),
-            "migrate": docstr_to_pars(CLI.migrate_db.__doc__),
-            "git": ("Wrapper around git inside the paper directory.",),
-            "grep": ("Wrapper around ripgrep inside the paper directory.",),
-        }
         width = min(shutil.get_terminal_size((80, 20)).columns, 100)
-        name_width = max(len(k) for k in commands) + 8
+        name_width = max(len(k) for k in _COMMANDS) + 8
         spacer = " " * name_width
 
-        for name, pars in commands.items():
+        for name, pars in _COMMANDS.items():
             print(f"{name:<{name_width}}", end="")
             for p in break_pars(pars, width-name_width):
                 print(f"{p}\n{spacer}", end="")
@@ -251,18 +254,18 @@ COMMANDS:""")
         """
         Read changes made in the markdown file into the database.
         """
-        repo_dir = db.get_paper_dir()
-        agency, number = path_safe_doi(doi)
-        fpath = os.path.join(repo_dir, agency, f"{number}.md")
+        from tack.docs import read_markdown
+
+        fpath = self._note_path(doi)
         doc = read_markdown(fpath)
 
         if doc is None:
             print(
-                f'{FMT.RED | FMT.BOLD}Error: Could not locate file at "{fpath}"{FMT.RESET}'
+                f'{ERR}Error: Could not locate file at "{fpath}"{FMT.RESET}'
             )
             return
 
-        with db.cursor() as cur:
+        with db.transaction() as cur:
             cur.execute(
                 "UPDATE papers SET title = ?, conference = ?, year = ?, abstract = ?, url = ? WHERE doi = ?",
                 (
@@ -274,27 +277,33 @@ COMMANDS:""")
                     doi,
                 ),
             )
-            non_special_attrs = {"aliases", "authors", "conference", "year", "url"}
             cur.execute("DELETE FROM tags WHERE doi = ?", (doi,))
 
-            for key, val in doc.meta.items():
-                if key in non_special_attrs:
-                    continue
-                cur.execute(
-                    "INSERT OR REPLACE INTO tags (`doi`, `name`, `value`) VALUES (?,?,?)",
-                    (doi, key, json.dumps(val)),
-                )
-                print(f"Read metadata {key} = {val}")
+            tags = {
+                key: val
+                for key, val in doc.meta.items()
+                if key not in db.NOTE_META_KEYS
+            }
+            cur.executemany(
+                "INSERT OR REPLACE INTO tags (`doi`, `name`, `value`) VALUES (?,?,?)",
+                ((doi, key, json.dumps(val)) for key, val in tags.items()),
+            )
+
+        if tags:
+            print("\n".join(f"Read metadata {key} = {val}" for key, val in tags.items()))
 
     def add_pdf(self, doi, path):
         """
         Add a pdf for a given paper. Takes a doi and a path to a paper and puts the pdf inside the paper directory. Also
         adds the paper as a link in the frontmatter of paper note.
         """
+        import shutil
+
         agency, number = path_safe_doi(doi)
-        dest = db.get_paper_dir()
-        os.makedirs((os.path.join(dest, 'pdf')), exist_ok=True)
-        shutil.copy(path, os.path.join(dest, "pdf", f"{agency}_{number}.pdf"))
+        dest = self.repo_dir
+        self._ensure_dir(os.path.join(dest, "pdf"))
+        # copyfile uses sendfile() where available, the pdf doesn't need the source's permission bits
+        shutil.copyfile(path, os.path.join(dest, "pdf", f"{agency}_{number}.pdf"))
         with db.cursor() as cur:
             cur.execute(
                 "INSERT OR REPLACE INTO tags (doi, name, value) VALUES (?,?,?)",
@@ -304,24 +313,20 @@ COMMANDS:""")
 
 
 def build_paper_meta_dict(
-    doi: str,
     title: str,
     year: int | str,
     conference: str | None,
     authors: list[db.AuthorOfPaper],
     url: str | None,
+    tags: list[tuple[str, str]],
 ) -> dict:
-    with db.cursor() as cur:
-        extra_tags = cur.execute(
-            "SELECT `name`, `value` FROM tags WHERE `doi` = ?", (doi,)
-        ).fetchall()
     return {
         "aliases": [title],
         "year": int(year),
         "conference": conference,
         "authors": [a.name for a in authors],
         "url": url,
-        **dict((k, json.loads(v)) for k, v in extra_tags),
+        **{k: json.loads(v) for k, v in tags},
     }
 
 
@@ -346,27 +351,45 @@ def docstr_to_pars(docstr: str) -> tuple[str, ...]:
 
 
 def break_pars(pars: Sequence[str], par_len: int) -> Iterable[str]:
+    """
+    Wrap paragraphs to lines of at most `par_len` characters, separating paragraphs by an empty line.
+    """
+    from textwrap import wrap
+
     is_first = True
     for par in pars:
         if not is_first:
             yield ""
         is_first = False
-
-        layout_par = []
-        size = 0
-        for w in par.split(' '):
-            if size + len(w) > par_len:
-                if not layout_par:
-                    yield w
-                    continue
-                yield " ".join(layout_par)
-                layout_par = [w]
-                size = len(w) + 1
-                continue
-            layout_par.append(w)
-            size += len(w) + 1
-        if layout_par:
-            yield " ".join(layout_par)
+        yield from wrap(par, par_len)
+
+
+# help text of all commands, as paragraphs
+_COMMANDS: dict[str, tuple[str, ...]] = {
+    "add": docstr_to_pars(CLI.add.__doc__),
+    "pdf": docstr_to_pars(CLI.add_pdf.__doc__),
+    "list": docstr_to_pars(CLI.list.__doc__),
+    "read-md": docstr_to_pars(CLI.read_md.__doc__),
+    "remove": docstr_to_pars(CLI.remove.__doc__),
+    "migrate": docstr_to_pars(CLI.migrate_db.__doc__),
+    "git": ("Wrapper around git inside the paper directory.",),
+    "grep": ("Wrapper around ripgrep inside the paper directory.",),
+}
+
+
+# command name -> (number of arguments or None for any number, handler)
+_DISPATCH: dict[str, tuple[int | None, Callable[..., None]]] = {
+    "migrate": (0, CLI.migrate_db),
+    "add": (1, lambda cli, doi: cli.add(normalize_doi(doi))),
+    "remove": (1, lambda cli, doi: cli.remove(normalize_doi(doi))),
+    "delete": (1, lambda cli, doi: cli.remove(normalize_doi(doi))),
+    "list": (None, lambda cli, *args: cli.list(list(args))),
+    "read-md": (1, lambda cli, doi: cli.read_md(normalize_doi(doi))),
+    "pdf": (2, lambda cli, doi, path: cli.add_pdf(normalize_doi(doi), path)),
+    "grep": (None, lambda cli, *args: cli._run_in_paper_dir("rg", *args)),
+    "git": (None, lambda cli, *args: cli._run_in_paper_dir("git", *args)),
+    "help": (None, lambda cli, *args: cli.help()),
+}
 
 
 def main():
@@ -1,4 +1,5 @@
 import sys
+from functools import cache
 from enum import Flag, auto
 
 COLOR_SUPPORT = hasattr(sys.stdout, "isatty") and sys.stdout.isatty()
@@ -15,6 +16,8 @@ class FMT(Flag):
     UNDERLINE = auto()
     RESET = auto()
 
+    # formats are constants, so each combination only has to be assembled once
+    @cache
     def __str__(self) -> str:
         if not COLOR_SUPPORT:
             return ""
@@ -5,29 +5,44 @@ Aimed at being as fast as possible, not importing all the other things.
 """
 
 import json
+import sqlite3
 import sys
+from contextlib import closing
 
 from tack import db
 
 
 def list_papers(mode: str):
-    with db.cursor() as cur:
-        results = cur.execute(
-            "SELECT doi, title, year, conference FROM papers"
-        ).fetchall()
-    segments = ("doi", "title", "year", "conference")
-
-    if mode == "csv":
-        print("doi,title,yera,conference")
-        print(
-            "\n".join(f'doi,"{title}",{year},"{conf}"')
-            for doi, title, year, conf in results
-        )
-    elif mode == "json":
-        json.dump([dict(zip(segments, line)) for line in results], sys.stdout)
-    elif mode == "jsonl":
-        for line in results:
-            print(json.dumps(dict(zip(segments, line))))
+    try:
+        conn = db.connect_read_only()
+    except sqlite3.Error:
+        # no database yet, nothing to complete
+        return
+
+    with closing(conn):
+        try:
+            results = conn.execute("SELECT doi, title, year, conference FROM papers")
+        except sqlite3.Error:
+            return
+        segments = ("doi", "title", "year", "conference")
+        encode = json.JSONEncoder(separators=(",", ":")).encode
+
+        if mode == "csv":
+            import csv
+
+            writer = csv.writer(sys.stdout, lineterminator="\n")
+            writer.writerow(segments)
+            writer.writerows(results)
+        elif mode == "json":
+            sys.stdout.write(
+                "["
+                + ",".join(encode(dict(zip(segments, line))) for line in results)
+                + "]"
+            )
+        elif mode == "jsonl":
+            sys.stdout.write(
+                "".join(encode(dict(zip(segments, line))) + "\n" for line in results)
+            )
 
 
 def main():
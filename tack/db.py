@@ -1,6 +1,11 @@
+import atexit
 import os
+import pathlib
+import queue
 import sqlite3
+import threading
 from contextlib import contextmanager
+from itertools import starmap
 from tack.models import Paper, AuthorOfPaper, Citation, CachedResponse
 import time
 from typing import ContextManager
@@ -8,7 +13,63 @@ import logging
 
 log = logging.getLogger(__name__)
 
-_CONNECTIONS: list[sqlite3.Connection] = list()
+# idle connections, the most recently used one is handed out first as its page cache is the warmest
+_POOL: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=4)
+
+_LOCAL = threading.local()
+
+_WAL_ENABLED = False
+
+# whether this process already made sure the schema is up to date
+_SCHEMA_CHECKED = False
+_SCHEMA_LOCK = threading.Lock()
+
+_PAPER_DIR: str | None = None
+
+# schema changes made after the initial schema, entry n upgrades the schema from version n+1 to n+2
+_MIGRATIONS: list[tuple[str, ...]] = [
+    (
+        # removing a paper removes everything attached to it, including authors that are now orphaned
+        """
+        CREATE TRIGGER IF NOT EXISTS papers_delete AFTER DELETE ON papers
+        BEGIN
+            DELETE FROM paper_authors WHERE doi = OLD.doi;
+            DELETE FROM tags WHERE doi = OLD.doi;
+            DELETE FROM cites WHERE source_doi = OLD.doi;
+            DELETE FROM authors WHERE orcid is null and id not in (SELECT author_id FROM paper_authors);
+        END
+        """,
+    ),
+    (
+        # the primary key already indexes query_cache.id
+        "DROP INDEX IF EXISTS query_cache_id",
+    ),
+    (
+        # author lookups by name are case-insensitive
+        "CREATE INDEX IF NOT EXISTS authors_name_nocase ON authors(name COLLATE NOCASE)",
+    ),
+    (
+        # these duplicate the indexes sqlite creates for primary keys and UNIQUE constraints
+        "DROP INDEX IF EXISTS paper_doi",
+        "DROP INDEX IF EXISTS authors_id",
+        "DROP INDEX IF EXISTS authors_orcid",
+        "DROP INDEX IF EXISTS tags_doi",
+        "DROP INDEX IF EXISTS paper_authors_doi",
+    ),
+]
+
+SCHEMA_VERSION = len(_MIGRATIONS) + 1
+
+# note metadata that is generated from the paper itself and never stored as a tag
+NOTE_META_KEYS = ("aliases", "authors", "conference", "year", "url")
+
+_PRAGMAS = (
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-65536",
+    "mmap_size=268435456",
+    "foreign_keys=ON",
+)
 
 
 def get_local_db_file_path() -> str:
@@ -21,34 +82,170 @@ def get_local_db_file_path() -> str:
     return os.path.join(conf_dir, "tack.db")
 
 
+def _connect() -> sqlite3.Connection:
+    """
+    Open a new connection to the local database, tuned for many small writes.
+    """
+    global _WAL_ENABLED, _SCHEMA_CHECKED
+    # transactions are managed explicitly by cursor() and transaction()
+    conn = sqlite3.connect(
+        get_local_db_file_path(),
+        check_same_thread=False,
+        cached_statements=256,
+        isolation_level=None,
+    )
+    # the journal mode is persisted in the database file, so we only need to set it once
+    if not _WAL_ENABLED:
+        conn.execute("PRAGMA journal_mode=WAL")
+        _WAL_ENABLED = True
+    for pragma in _PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+
+    # bring existing databases up to date once per process, fresh ones are set up by migrate()
+    if not _SCHEMA_CHECKED:
+        with _SCHEMA_LOCK:
+            if not _SCHEMA_CHECKED:
+                _auto_upgrade(conn)
+                _SCHEMA_CHECKED = True
+    return conn
+
+
+def _auto_upgrade(conn: sqlite3.Connection):
+    cur = conn.cursor()
+    if cur.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+    if not _has_schema(cur):
+        return
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        _upgrade_schema(cur)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        conn.close()
+        raise
+
+
+def connect_read_only() -> sqlite3.Connection:
+    """
+    Open a bare read-only connection, skipping pragmas and schema upgrades.
+
+    Meant for short-lived processes like shell completions, where opening the database is most of the work.
+    """
+    uri = pathlib.Path(get_local_db_file_path()).absolute().as_uri()
+    return sqlite3.connect(f"{uri}?mode=ro", uri=True)
+
+
 @contextmanager
 def cursor(read_only: bool = False) -> ContextManager[sqlite3.Cursor]:
     """
     Hand out a new cursor on a connection. Connections are re-used in a connection pool.
 
-    Connections are automatically committed if no exception occurred.
+    Writing cursors run inside a transaction that takes the write lock right away (BEGIN IMMEDIATE), and is committed
+    if no exception occurred, and rolled back otherwise. Read-only cursors run outside of a transaction.
+
+    Inside a `transaction()` block, the cursor is handed out on the transactions connection instead, and committing
+    is left to the transaction.
     """
-    if not _CONNECTIONS:
-        conn = sqlite3.connect(get_local_db_file_path(), check_same_thread=False)
-    else:
-        conn = _CONNECTIONS.pop()
+    if (conn := getattr(_LOCAL, "transaction", None)) is not None:
+        yield conn.cursor()
+        return
+
+    try:
+        conn = _POOL.get_nowait()
+    except queue.Empty:
+        conn = _connect()
     cur = conn.cursor()
     try:
-        yield cur
         if not read_only:
+            cur.execute("BEGIN IMMEDIATE")
+        yield cur
+        # executescript() commits on its own, so the transaction may already be over
+        if not read_only and conn.in_transaction:
             conn.commit()
-    except Exception as ex:
-        conn.rollback()
-        raise ex
+    finally:
+        # never return a connection with a dangling transaction to the pool
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _POOL.put_nowait(conn)
+        except queue.Full:
+            _close(conn)
+
+
+def _close(conn: sqlite3.Connection):
+    """
+    Close a connection, letting sqlite refresh the query planner statistics it found lacking while it was open.
+    """
+    try:
+        conn.execute("PRAGMA optimize")
+    except sqlite3.Error:
+        # only a missed optimization, e.g. when another connection holds the lock
+        pass
+    finally:
+        conn.close()
+
+
+@atexit.register
+def _close_pool():
+    while True:
+        try:
+            conn = _POOL.get_nowait()
+        except queue.Empty:
+            return
+        _close(conn)
+
+
+@contextmanager
+def transaction() -> ContextManager[sqlite3.Cursor]:
+    """
+    Group all database operations of this thread inside the block into a single transaction.
+
+    The transaction is committed at the end of the block, or rolled back if an exception occurred.
+    """
+    if (conn := getattr(_LOCAL, "transaction", None)) is not None:
+        # nested transactions are merged into the outer one
+        yield conn.cursor()
+        return
+
+    with cursor() as cur:
+        _LOCAL.transaction = cur.connection
+        try:
+            yield cur
+        finally:
+            _LOCAL.transaction = None
 
 
 def migrate():
     with cursor() as cur:
-        res = cur.execute(
+        if not _has_schema(cur):
+            # this commits the transaction, start a new one for the upgrades
+            _create_schema(cur)
+            cur.execute("BEGIN IMMEDIATE")
+        _upgrade_schema(cur)
+
+
+def _has_schema(cur: sqlite3.Cursor) -> bool:
+    return (
+        cur.execute(
             "SELECT name FROM sqlite_master WHERE type='table' AND name='tack_settings';"
         ).fetchone()
-        if res is None:
-            _create_schema(cur)
+        is not None
+    )
+
+
+def _upgrade_schema(cur: sqlite3.Cursor):
+    """
+    Apply all migrations that the database is missing.
+    """
+    # databases created before versioning was introduced report version 0
+    version = max(cur.execute("PRAGMA user_version").fetchone()[0], 1)
+    for statements in _MIGRATIONS[version - 1 :]:
+        for statement in statements:
+            cur.execute(statement)
+    if version < SCHEMA_VERSION:
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        log.info(f"Upgraded database schema to version {SCHEMA_VERSION}")
 
 
 def add_paper(paper: Paper) -> bool:
@@ -68,23 +265,65 @@ def add_paper(paper: Paper) -> bool:
         return id is not None
 
 
+def add_paper_full(
+    paper: Paper, authors: list[AuthorOfPaper], citations: list[Citation]
+) -> bool:
+    """
+    Add a paper together with its authors and citations in a single transaction.
+
+    Authors and citations are only added if the paper was not in the database yet.
+    """
+    with transaction():
+        if not add_paper(paper):
+            return False
+        add_authors(paper.doi, authors)
+        add_citations(paper.doi, citations)
+        return True
+
+
+def has_paper(doi: str) -> bool:
+    with cursor(read_only=True) as cur:
+        return (
+            cur.execute("SELECT 1 FROM papers WHERE doi = ?", (doi,)).fetchone()
+            is not None
+        )
+
+
 def add_authors(doi: str, authors: list[AuthorOfPaper]):
-    with cursor() as cur:
+    with transaction() as cur:
+        # authors with an orcid are inserted in one go, and their ids resolved in one query afterwards
+        new_with_orcid = [a for a in authors if a.id is None and a.orcid is not None]
+        cur.executemany(
+            "INSERT OR IGNORE INTO authors (`orcid`, `name`) VALUES (?, ?)",
+            ((a.orcid, a.name) for a in new_with_orcid),
+        )
+        ids_by_orcid = {}
+        orcids = list({a.orcid: None for a in new_with_orcid})
+        for i in range(0, len(orcids), 500):
+            chunk = orcids[i : i + 500]
+            ids_by_orcid.update(
+                cur.execute(
+                    "SELECT orcid, id FROM authors WHERE orcid IN ({})".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    chunk,
+                )
+            )
+
         author_ids = []
         for author in authors:
-            if author.id is None:
-                result = cur.execute(
-                    "INSERT OR IGNORE INTO authors (`orcid`, `name`) VALUES (?, ?) RETURNING id",
-                    (author.orcid, author.name),
-                ).fetchone()
-                if result is None:
-                    result = cur.execute(
-                        "SELECT id FROM authors WHERE orcid = ? LIMIT 1",
-                        (author.orcid,),
-                    ).fetchone()
-                author_ids.append(result[0])
-            else:
+            if author.id is not None:
                 author_ids.append(author.id)
+            elif author.orcid is not None:
+                author_ids.append(ids_by_orcid[author.orcid])
+            else:
+                # authors without orcid are never de-duplicated, each one is a new row
+                author_ids.append(
+                    cur.execute(
+                        "INSERT INTO authors (`orcid`, `name`) VALUES (NULL, ?)",
+                        (author.name,),
+                    ).lastrowid
+                )
 
         cur.executemany(
             "INSERT OR IGNORE INTO paper_authors (`doi`, `author_id`, `idx`, `affiliation`) VALUES (?, ?, ?, ?)",
@@ -95,12 +334,34 @@ def add_authors(doi: str, authors: list[AuthorOfPaper]):
         )
 
 
+# rows per multi-row INSERT into cites, staying below sqlite's default limit of 999 parameters
+_CITES_CHUNK = 999 // 6
+
+# insert statements by row count, so that sqlite3's statement cache sees the exact same sql again
+_CITES_INSERT_SQL: dict[int, str] = {}
+
+
+def _cites_insert_sql(rows: int) -> str:
+    if (sql := _CITES_INSERT_SQL.get(rows)) is None:
+        sql = _CITES_INSERT_SQL[rows] = (
+            "INSERT INTO cites (source_doi, title, journal, doi, year, author) VALUES "
+            + ",".join(["(?,?,?,?,?,?)"] * rows)
+        )
+    return sql
+
+
 def add_citations(doi: str, citations: list[Citation]):
     with cursor() as cur:
-        cur.executemany(
-            "INSERT INTO cites (source_doi, title, journal, doi, year, author) VALUES (?,?,?,?,?,?)",
-            ((doi, c.title, c.journal, c.doi, c.year, c.author) for c in citations),
-        )
+        for i in range(0, len(citations), _CITES_CHUNK):
+            chunk = citations[i : i + _CITES_CHUNK]
+            cur.execute(
+                _cites_insert_sql(len(chunk)),
+                [
+                    val
+                    for c in chunk
+                    for val in (doi, c.title, c.journal, c.doi, c.year, c.author)
+                ],
+            )
 
 
 def similar_authors(name: str) -> list[tuple[int, str, str, int]]:
@@ -108,17 +369,41 @@ def similar_authors(name: str) -> list[tuple[int, str, str, int]]:
         return cur.execute(
             "SELECT authors.id, authors.name, papers.title, papers.year "
             "FROM authors "
-            "CROSS JOIN paper_authors "
-            "CROSS JOIN papers "
-            "WHERE paper_authors.doi = papers.doi "
-            "  AND paper_authors.author_id = authors.id "
-            "  AND name = ? COLLATE NOCASE "
+            "JOIN paper_authors ON paper_authors.author_id = authors.id "
+            "JOIN papers ON papers.doi = paper_authors.doi "
+            "WHERE authors.name = ? COLLATE NOCASE "
             "ORDER BY authors.id, papers.year DESC",
             (name,),
         ).fetchall()
 
 
+def get_local_citations(dois: list[str]) -> dict[str, Citation]:
+    """
+    Build citations for all DOIs that are already in the local database, using their first author.
+    """
+    results = {}
+    with cursor(read_only=True) as cur:
+        for i in range(0, len(dois), 500):
+            chunk = dois[i : i + 500]
+            for doi, title, conference, year, author in cur.execute(
+                "SELECT papers.doi, papers.title, papers.conference, papers.year, ("
+                "  SELECT authors.name FROM paper_authors JOIN authors ON authors.id = paper_authors.author_id"
+                "  WHERE paper_authors.doi = papers.doi ORDER BY paper_authors.idx LIMIT 1"
+                ") FROM papers WHERE papers.doi IN ({})".format(",".join("?" * len(chunk))),
+                chunk,
+            ):
+                results[doi] = Citation(title, conference, doi, year, author)
+    return results
+
+
 def get_paper_dir() -> str:
+    """
+    The folder notes are stored in. Tack never changes it while running, so it is only read once per process.
+    """
+    global _PAPER_DIR
+    if _PAPER_DIR is not None:
+        return _PAPER_DIR
+
     with cursor(read_only=True) as cur:
         home: str = cur.execute(
             "SELECT `folder` from tack_settings ORDER BY `schema_version` DESC LIMIT 1"
@@ -126,29 +411,69 @@ def get_paper_dir() -> str:
 
     # perform replacement of `~`
     if home.startswith("~/"):
-        return os.environ.get("HOME") + home[1:]
+        home = os.environ.get("HOME") + home[1:]
+    _PAPER_DIR = home
     return home
 
 
-def get_authors(doi: str) -> list[AuthorOfPaper]:
+def get_note_bundle(
+    doi: str,
+) -> tuple[Paper | None, list[AuthorOfPaper], list[Citation], list[tuple[str, str]]]:
+    """
+    Read everything needed to render the note of a paper: the paper, its authors, its citations and its tags.
+
+    All reads happen in a single read transaction on one connection.
+    """
     with cursor(read_only=True) as cur:
-        authors = cur.execute(
-            "SELECT authors.`id`, authors.`orcid`, authors.`name`, paper_authors.`affiliation` "
-            "FROM authors JOIN paper_authors ON authors.id = paper_authors.author_id "
-            "WHERE paper_authors.doi = ? "
-            "ORDER BY paper_authors.idx",
-            (doi,),
-        ).fetchall()
-    return [AuthorOfPaper(*args) for args in authors]
+        cur.execute("BEGIN DEFERRED")
+        try:
+            paper = cur.execute(
+                "SELECT `doi`, `title`, `conference`, `year`, `abstract`, `url` FROM papers WHERE `doi` = ?",
+                (doi,),
+            ).fetchone()
+            if paper is None:
+                return None, [], [], []
+            tags = cur.execute(
+                "SELECT `name`, `value` FROM tags WHERE `doi` = ? AND `name` NOT IN ({})".format(
+                    ",".join("?" * len(NOTE_META_KEYS))
+                ),
+                (doi, *NOTE_META_KEYS),
+            ).fetchall()
+            return (
+                Paper(*paper),
+                _get_authors(cur, doi),
+                _get_paper_citations(cur, doi),
+                tags,
+            )
+        finally:
+            cur.execute("COMMIT")
+
+
+def _get_authors(cur: sqlite3.Cursor, doi: str) -> list[AuthorOfPaper]:
+    return list(
+        starmap(
+            AuthorOfPaper,
+            cur.execute(
+                "SELECT authors.`id`, authors.`orcid`, authors.`name`, paper_authors.`affiliation` "
+                "FROM authors JOIN paper_authors ON authors.id = paper_authors.author_id "
+                "WHERE paper_authors.doi = ? "
+                "ORDER BY paper_authors.idx",
+                (doi,),
+            ),
+        )
+    )
 
 
-def get_paper_citations(doi: str) -> list[Citation]:
-    with cursor(read_only=True) as cur:
-        cites = cur.execute(
-            "SELECT `title`, `journal`, `doi`, `year`, `author` FROM cites WHERE source_doi = ? ORDER BY rowid",
-            (doi,),
-        ).fetchall()
-    return [Citation(*args) for args in cites]
+def _get_paper_citations(cur: sqlite3.Cursor, doi: str) -> list[Citation]:
+    return list(
+        starmap(
+            Citation,
+            cur.execute(
+                "SELECT `title`, `journal`, `doi`, `year`, `author` FROM cites WHERE source_doi = ? ORDER BY rowid",
+                (doi,),
+            ),
+        )
+    )
 
 
 def cache_response(
@@ -169,10 +494,10 @@ def has_cached_response(
 ) -> CachedResponse | None:
     with cursor(read_only=True) as cur:
         query_args = [id]
-        query = "SELECT id, time, extra, response FROM query_cache WHERE id = ?"
+        query = "SELECT id, extra, time, response FROM query_cache WHERE id = ?"
         if meta is not None:
             query_args.append(meta)
-            query += " AND meta = ?"
+            query += " AND extra = ?"
         if timeout > 0:
             query_args.append(int(time.time()) - timeout)
             query += " AND time > ?"
@@ -183,6 +508,25 @@ def has_cached_response(
         return CachedResponse(*data)
 
 
+def get_cached_responses(ids: list[str]) -> dict[str, CachedResponse]:
+    """
+    Look up many cached responses at once, returns only the ids that were found.
+    """
+    results = {}
+    with cursor(read_only=True) as cur:
+        # stay well below SQLites limit on the number of query parameters
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            for data in cur.execute(
+                "SELECT id, extra, time, response FROM query_cache WHERE id IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            ):
+                results[data[0]] = CachedResponse(*data)
+    return results
+
+
 def _create_schema(cur: sqlite3.Cursor):
     cur.executescript(
         """
@@ -195,8 +539,6 @@ def _create_schema(cur: sqlite3.Cursor):
           url text
         );
         
-        CREATE INDEX paper_doi ON papers(doi);
-        
         CREATE TABLE tack_settings (
             schema_version integer not null,
             folder text not null
@@ -211,8 +553,6 @@ def _create_schema(cur: sqlite3.Cursor):
             UNIQUE(doi, name)
         );
         
-        CREATE INDEX tags_doi ON tags(doi);
-        
         CREATE TABLE authors (
             id integer primary key autoincrement not null,
             orcid char(32),
@@ -220,8 +560,7 @@ def _create_schema(cur: sqlite3.Cursor):
             UNIQUE(orcid)
         );
         
-        CREATE INDEX authors_id ON authors(id);
-        CREATE INDEX authors_orcid ON authors(orcid);
+        CREATE INDEX authors_name_nocase ON authors(name COLLATE NOCASE);
         
         CREATE TABLE paper_authors (
             doi char(32) not null,
@@ -231,8 +570,6 @@ def _create_schema(cur: sqlite3.Cursor):
             UNIQUE(doi, author_id)
         );
         
-        CREATE INDEX paper_authors_doi ON paper_authors(doi);
-        
         CREATE TABLE cites (
             source_doi char(32),
             title text,
@@ -251,8 +588,8 @@ def _create_schema(cur: sqlite3.Cursor):
             extra text,
             response text
         );
-        
-        CREATE INDEX query_cache_id ON query_cache(id);
+
+        ANALYZE;
     """
     )
     log.info("Created database schema")
@@ -3,16 +3,21 @@ Handles the writing/reading of the markdown files
 """
 
 import os
+import re
 from dataclasses import dataclass
 
 import yaml
-from collections.abc import Iterable, Iterator, Generator
-from typing import Callable
+from collections.abc import Iterable, Generator
 
 from tack import db, models, helpers
 
+try:
+    from yaml import CSafeDumper as _SafeDumper, CSafeLoader as _SafeLoader
+except ImportError:  # libyaml bindings are not available
+    from yaml import SafeDumper as _SafeDumper, SafeLoader as _SafeLoader
 
-@dataclass
+
+@dataclass(slots=True)
 class MarkdownFile:
     path: str
     meta: dict
@@ -31,9 +36,9 @@ class MarkdownFile:
     users notes
     """
 
-    references: list[str]
+    references: Iterable[str]
     """
-    References, if present
+    References, if present. May be a generator, which is consumed when writing the file.
     """
 
 
@@ -41,149 +46,129 @@ def read_markdown(path) -> MarkdownFile | None:
     if not os.path.exists(path):
         return None
 
-    with open(path, "r") as f:
-        return MarkdownLinesParser(path, f).parse()
-
-
-class Peekable(Iterator[str]):
-    wrapped: Iterator[str]
-    next: str | None
+    with open(path, "r", encoding="utf-8") as f:
+        return MarkdownParser(path, f.read()).parse()
 
-    def __init__(self, wrap: Iterator[str]):
-        self.wrapped = wrap
-        self.next = None
-
-    def __next__(self) -> str:
-        if self.next is not None:
-            next_item = self.next
-            self.next = None
-        else:
-            next_item = next(self.wrapped)
 
-        return next_item
+class ParseError(ValueError):
+    pass
 
-    def peek(self) -> str | None:
-        if self.next is None:
-            try:
-                self.next = next(self.wrapped)
-            except StopIteration:
-                pass
-        return self.next
 
+# yaml front matter between two lines starting with ---
+_META_RE = re.compile(r"\A---[^\n]*\n(.*?)^---[^\n]*$", re.M | re.S)
+# the title must be the first non-empty line after the front matter
+_TITLE_RE = re.compile(r"\s*^[ \t]*# ([^\n]*)$", re.M)
+_SECTION_RE = re.compile(r"^[ \t]*## (Abstract|Notes|References)\b[^\n]*$", re.M)
+# consecutive list items directly after the references heading
+_REFERENCES_RE = re.compile(r"\n?((?:[ \t]*- [^\n]*(?:\n|\Z))*)")
 
-class ParseError(ValueError):
-    pass
 
+class MarkdownParser:
+    """
+    Splits a note into its sections. Section headings are located by regex over the whole text, and each section is
+    sliced out of the text between two headings.
+    """
 
-class MarkdownLinesParser:
-    lines: Peekable
+    text: str
     fname: str
 
-    def __init__(self, fname: str, lines: Iterable[str]):
-        self.lines = Peekable(iter(lines))
+    def __init__(self, fname: str, text: str):
+        self.text = text
         self.fname = fname
 
     def parse(self) -> MarkdownFile:
-        meta = self.parse_meta()
-        title = self.parse_title()
-        abstract = self.parse_abstract()
-        notes = self.parse_notes()
-        refs = self.parse_references()
+        meta, pos = self.parse_meta()
+        title, pos = self.parse_title(pos)
+
+        sections = {}
+        for match in _SECTION_RE.finditer(self.text, pos):
+            # only the first occurrence of a heading counts, later ones are part of the section before
+            sections.setdefault(match.group(1), match)
+
+        notes = sections.get("Notes")
+        if notes is None:
+            raise ParseError(f"{self.fname}: Expected notes section")
+        refs = sections.get("References")
+        if refs is None or refs.start() < notes.end():
+            raise ParseError(f"{self.fname}: Expected references after notes")
+
+        abstract = sections.get("Abstract")
+        if abstract is not None and abstract.start() < notes.start():
+            abstract = self.text[abstract.end() : notes.start()].strip("\n")
+        else:
+            abstract = None
 
         return MarkdownFile(
             self.fname,
             meta,
             title,
             abstract,
-            notes,
-            refs,
+            self.text[notes.end() : refs.start()].strip("\n"),
+            self.parse_references(refs.end()),
         )
 
-    def parse_meta(self):
-        if not self.lines.peek().startswith("---"):
-            return {}
-        # eat leading ---
-        next(self.lines)
-        meta = self._take_while(lambda x: not x.startswith("---"))
-        # eat trailing ---
-        next(self.lines)
-        return yaml.safe_load("\n".join(meta))
-
-    def parse_title(self) -> str:
-        # eat empty lines
-        self._take_empty()
-
-        if not self.lines.peek().strip().startswith("# "):
-            raise ParseError(f"Expected title here, got: {self.lines.peek()}")
-
-        return next(self.lines).removeprefix("# ").strip("\n")
-
-    def parse_abstract(self) -> str | None:
-        self._take_empty()
-        if not self.lines.peek().strip().startswith("## Abstract"):
-            return None
-        # eat hading
-        next(self.lines)
-        abstract = self._take_while(lambda x: not x.strip().startswith("## "))
-        return "\n".join(abstract).strip("\n")
-
-    def parse_notes(self) -> str | None:
-        self._take_empty()
-        if not self.lines.peek().strip().startswith("## Notes"):
-            raise ParseError(f"Expected notes, got {self.lines.peek()}")
-
-        # eat hading
-        next(self.lines)
-        notes = self._take_while(lambda x: not x.strip().startswith("## "))
-        return "\n".join(notes).strip("\n")
-
-    def parse_references(self) -> list[str]:
-        self._take_empty()
-        if not self.lines.peek().strip().startswith("## References"):
-            raise ParseError(f"Expected References, got {self.lines.peek()}")
-        # eat heading
-        next(self.lines)
-
-        references = self._take_while(
-            lambda x: x is not None and x.strip().startswith("- ")
-        )
-        return references
+    def parse_meta(self) -> tuple[dict, int]:
+        match = _META_RE.match(self.text)
+        if match is None:
+            return {}, 0
+        return yaml.load(match.group(1), Loader=_SafeLoader) or {}, match.end()
 
-    def _take_while(self, pred: Callable[[str], bool]):
-        parts = []
-        while pred(self.lines.peek()):
-            parts.append(next(self.lines))
+    def parse_title(self, pos: int) -> tuple[str, int]:
+        match = _TITLE_RE.match(self.text, pos)
+        if match is None:
+            line = self.text[pos:].strip().partition("\n")[0]
+            raise ParseError(f"{self.fname}: Expected title here, got: {line}")
+        return match.group(1), match.end()
 
-        return parts
+    def parse_references(self, pos: int) -> list[str]:
+        return _REFERENCES_RE.match(self.text, pos).group(1).splitlines()
 
-    def _take_empty(self):
-        self._take_while(lambda x: not x.strip())
 
+def render_markdown(doc: MarkdownFile) -> bytes:
+    """
+    Serialize the document into the exact bytes that end up on disk.
+    """
+    parts = [
+        f"---\n{yaml.dump(doc.meta, Dumper=_SafeDumper)}---",
+        f"\n# {doc.title}",
+    ]
+    if doc.abstract:
+        parts.append(f"\n\n## Abstract:\n{doc.abstract}")
+    parts.append(f"\n\n## Notes:\n{doc.notes if doc.notes is not None else ''}")
+    parts.append("\n\n## References:\n")
+    parts.append("\n".join(doc.references))
+    return "".join(parts).encode("utf-8")
+
+
+def write_markdown(doc: MarkdownFile) -> bool:
+    """
+    Write the document to doc.path, unless the file already holds the exact same
+    content. Returns True if the file was written.
+    """
+    content = render_markdown(doc)
+    try:
+        if os.stat(doc.path).st_size == len(content):
+            with open(doc.path, "rb") as f:
+                if f.read() == content:
+                    return False
+    except FileNotFoundError:
+        pass
 
-def write_markdown(doc: MarkdownFile):
-    with open(doc.path, "w") as f:
-        f.write(f"---\n{yaml.safe_dump(doc.meta)}---")
-        f.write(f"\n# {doc.title}")
-        if doc.abstract:
-            f.write(f"\n\n## Abstract:\n{doc.abstract}")
-        f.write(f"\n\n## Notes:\n{doc.notes if doc.notes is not None else ''}")
-        f.write(f"\n\n## References:\n")
-        f.write("\n".join(doc.references))
+    with open(doc.path, "wb") as f:
+        f.write(content)
+    return True
 
 
-def build_refs(cites: list[models.Citation]) -> Generator[str, None, None]:
+def build_refs(cites: Iterable[models.Citation]) -> Generator[str, None, None]:
     for cite in cites:
-        suffix = " ("
+        parts = []
         if cite.author:
-            suffix += f"{cite.author} et. al. "
+            parts.append(f"{cite.author} et. al.")
         if cite.journal:
-            suffix += f"at {cite.journal} "
+            parts.append(f"at {cite.journal}")
         if cite.year:
-            suffix += f"- {cite.year}"
-        if suffix == " (":
-            suffix = ""
-        else:
-            suffix += ")"
+            parts.append(f"- {cite.year}")
+        suffix = f" ({' '.join(parts)})" if parts else ""
 
         if cite.doi:
             fancy = ""
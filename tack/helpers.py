@@ -1,9 +1,49 @@
 import html.parser
+import json
 import random
 import re
+import threading
 import time
+from concurrent.futures import CancelledError
 from contextlib import contextmanager
 from dataclasses import dataclass, field
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+
+def json_loads(data: str | bytes):
+    """
+    Decode JSON, using orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumpb(obj) -> bytes:
+    """
+    Encode an object to compact JSON bytes, using orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    # orjson writes raw utf-8, match it so that the output doesn't depend on what is installed
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def json_dumps(obj) -> str:
+    """
+    Encode an object to a compact JSON string, using orjson if it is installed.
+    """
+    return json_dumpb(obj).decode()
 
 
 class ExtractHTMLText(html.parser.HTMLParser):
@@ -22,15 +62,23 @@ class ExtractHTMLText(html.parser.HTMLParser):
 
 def html_to_plain(value: str):
     """
-    Converts an HTML encoded string into plain text. Note that this may result in the string containing HTML entities.
+    Converts an HTML encoded string into plain text, using selectolax if it is installed. Note that this may result
+    in the string containing HTML entities.
     """
+    if LexborHTMLParser is not None:
+        return LexborHTMLParser(value).text(separator="")
     x = ExtractHTMLText()
     x.feed(value)
     return x.get_text()
 
 
-@dataclass
+@dataclass(slots=True)
 class RateLimiter:
+    """
+    Token bucket rate limiter: allows bursts of up to `num_requests` requests, refilling at a rate of
+    `num_requests / interval` requests per second. Requests only wait when the bucket is empty.
+    """
+
     num_requests: int
     interval: float | int
     random_stagger: float = field(default=0)
@@ -38,23 +86,54 @@ class RateLimiter:
     Introduces a slight delay between requests to stagger them 
     """
 
-    bucket_start: float = field(default_factory=time.time, init=False)
-    bucket_count: int = field(default=0, init=False)
+    tokens: float = field(init=False)
+    last_refill: float = field(default_factory=time.monotonic, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def __post_init__(self):
+        self.tokens = self.num_requests
+
+    @property
+    def rate(self) -> float:
+        return self.num_requests / self.interval
+
+    def acquire(self) -> float:
+        """
+        Take a token from the bucket. Returns the time in seconds the caller has to wait before the token is
+        valid, this is zero if the bucket was not empty.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.num_requests, self.tokens + (now - self.last_refill) * self.rate
+            )
+            self.last_refill = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            # we went into debt, wait until the token we took is refilled
+            return -self.tokens / self.rate
 
     @contextmanager
-    def session(self):
-        if self.random_stagger > 0:
-            time.sleep(self.random_stagger * random.random())
-        while self.bucket_count >= self.num_requests:
-            if self.bucket_start + self.interval < time.time():
-                self.bucket_count = 0
-                self.bucket_start = time.time()
-                continue
-            time.sleep(0.01)
-        self.bucket_count += 1
+    def session(self, cancelled: threading.Event | None = None):
+        """
+        Wait for a free slot before running the block. If `cancelled` is set while waiting, the wait ends early with
+        a CancelledError instead.
+        """
+        delay = self.random_stagger * random.random() if self.random_stagger > 0 else 0
+        delay += max(self.acquire(), 0)
+        if cancelled is None:
+            if delay > 0:
+                time.sleep(delay)
+        elif cancelled.wait(delay):
+            raise CancelledError()
         yield
 
 
+_DOI_UNSAFE_CHARS = str.maketrans(":/", "__")
+
+
+@lru_cache(maxsize=128)
 def path_safe_doi(doi: str) -> tuple[str, str]:
     """
     Split the DOI into agency and number, and replace all path-unsafe characters in the DOI with `_`
@@ -62,7 +141,7 @@ def path_safe_doi(doi: str) -> tuple[str, str]:
     Let's hope there are no name clashes lol.
     """
     agency, number = doi.split("/", maxsplit=1)
-    return agency, re.sub(r"[:/]", "_", number)
+    return agency, number.translate(_DOI_UNSAFE_CHARS)
 
 
 def normalize_doi(doi: str) -> str:
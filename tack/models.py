@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-@dataclass
+@dataclass(slots=True)
 class AuthorOfPaper:
     id: int | None
     orcid: str
@@ -8,7 +8,7 @@ class AuthorOfPaper:
     affiliation: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Citation:
     title: str | None
     journal: str | None
@@ -17,7 +17,7 @@ class Citation:
     author: str | None
 
 
-@dataclass
+@dataclass(slots=True)
 class Paper:
     doi: str
     title: str
@@ -28,7 +28,7 @@ class Paper:
 
 
 
-@dataclass
+@dataclass(slots=True)
 class CachedResponse:
     id: str
     meta: str | None
@@ -1,4 +1,3 @@
-import math
 import shutil
 import time
 from dataclasses import dataclass, field
@@ -13,44 +12,56 @@ class ProgressBar:
 
     _cli_width: int = field(default=0, init=False)
     _reserved_space: int = field(default=0, init=False)
+    _digits: int = field(default=1, init=False)
+    _last_bar_width: int = field(default=-1, init=False)
     _print_lock: threading.Lock = field(default_factory=threading.Lock, init=False)
 
     def __post_init__(self):
         self._cli_width = min(shutil.get_terminal_size((80, 20)).columns, 100)
+        self._layout()
+
+    def _layout(self):
+        """
+        Calculate the space taken up by everything but the bar, this only changes with the size.
+        """
         # calculate free space
         # 2 for []
-        # log10(size)*2 + 1 for n/size
+        # digits*2 + 1 for n/size
         # 2 for () surrounding progress
         # 1 for one extra space
         # somehow I missed two somewhere?
-
-        if self.size == 0:
-            self._reserved_space = 9
-            return
-        self._reserved_space = 2 + 1 + math.ceil(math.log10(self.size))*2 + 2 + 1 + 2
+        self._digits = len(str(self.size))
+        self._reserved_space = 2 + 1 + self._digits * 2 + 2 + 1 + 2
+        self._last_bar_width = -1
 
     def update_size(self, new_size: int):
         self.size = new_size
-        self._reserved_space = 2 + 1 + math.ceil(math.log10(self.size))*2 + 2 + 1 + 2
+        self._layout()
         self.draw()
 
     def increment(self):
-        self.state += 1
+        with self._print_lock:
+            self.state += 1
         self.draw()
 
     def draw(self):
-        if self.state > self.size or self.size == 0:
-            print("done!", end="", flush=True)
-            return
-
-        progress_width = self._cli_width - self._reserved_space
+        with self._print_lock:
+            # read the state once, other threads may increment it concurrently
+            state = self.state
+            if state > self.size or self.size == 0:
+                print("done!", end="", flush=True)
+                return
 
-        status = f"({self.state:>{math.ceil(math.log10(self.size))}}/{self.size})"
-        bar = "=" * int(progress_width * self.state / self.size)
+            progress_width = self._cli_width - self._reserved_space
+            bar_width = int(progress_width * state / self.size)
 
-        with self._print_lock:
-            print(f"\r", end=f"[{bar:<{progress_width}}] {status}", flush=True)
+            # only redraw if the bar itself moved, or to show the final count
+            if bar_width == self._last_bar_width and state != self.size:
+                return
+            self._last_bar_width = bar_width
 
+            status = f"({state:>{self._digits}}/{self.size})"
+            print(f"\r", end=f"[{'=' * bar_width:<{progress_width}}] {status}", flush=True)
 
 
 if __name__ == '__main__':